@@ -1,4 +1,8 @@
+import os
+import json
 import sqlite3
+from collections import OrderedDict
+import threading
 import numpy as np
 from scipy.io import savemat
 from PyQt5.QtGui import QIcon
@@ -61,6 +65,145 @@ events_schema = {'lname': 'log_name',
 
 adas_tables = 'adas_events'
 
+# saved queries and query history, kept across sessions
+history_db = os.path.join(os.path.expanduser('~'), '.adas_finder.db')
+
+
+# Persistent store of saved and previously submitted queries. Queries are kept as
+# their predicate lists (the same [combinator, schema, operator, value] items used
+# by the main window, value being the bare user input), so they are rebuilt into
+# parameterized SQL rather than replayed as raw query text.
+class QueryStore(object):
+
+    def __init__(self, file_name):
+        self.db = sqlite3.connect(file_name)
+        self.db.execute("CREATE TABLE IF NOT EXISTS query_history ("
+                        "predicates TEXT PRIMARY KEY, "
+                        "hits INTEGER NOT NULL DEFAULT 0, "
+                        "saved INTEGER NOT NULL DEFAULT 0, "
+                        "last_used TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
+        self.db.commit()
+
+    def record(self, query_val, saved=False):
+        key = json.dumps(query_val)
+        self.db.execute("INSERT OR IGNORE INTO query_history (predicates) VALUES (?)", (key,))
+        if saved:
+            self.db.execute("UPDATE query_history SET saved = 1 WHERE predicates = ?", (key,))
+        else:
+            self.db.execute("UPDATE query_history SET hits = hits + 1, last_used = CURRENT_TIMESTAMP "
+                            "WHERE predicates = ?", (key,))
+        self.db.commit()
+
+    def most_used(self, limit):
+        # saved queries first, then the most frequently and recently used ones
+        c = self.db.execute("SELECT predicates FROM query_history "
+                            "ORDER BY saved DESC, hits DESC, last_used DESC")
+
+        queries = []
+        for x in c:
+            try:
+                query_val = json.loads(x[0])
+            except ValueError:
+                continue
+
+            # skip rows that are not a list of predicates
+            if self.check_predicates(query_val):
+                queries.append(query_val)
+                if len(queries) == limit:
+                    break
+
+        return queries
+
+    def check_predicates(self, query_val):
+        if not isinstance(query_val, list) or not query_val:
+            return False
+
+        for x in query_val:
+            if not isinstance(x, list) or len(x) != 4:
+                return False
+            if not all(isinstance(y, str) for y in x):
+                return False
+
+        return True
+
+    def close(self):
+        self.db.close()
+
+
+# Low priority worker that runs the most used queries right after a database is
+# opened, so their results land in the result cache (and their pages in the OS page
+# cache) before the user asks for them. It uses its own connection, pauses while an
+# interactive query is running (a progress handler aborts its statement) and stops
+# as soon as the database is changed by someone else (PRAGMA data_version moves).
+class PrefetchWorker(QThread):
+
+    result_ready = pyqtSignal(object, object)
+
+    def __init__(self, file_name, queries, parent=None):
+        super(PrefetchWorker, self).__init__(parent)
+
+        self.file_name = file_name
+        self.queries = queries
+        self.db = None
+        self._idle = threading.Event()
+        self._idle.set()
+
+    def run(self):
+        try:
+            self.db = sqlite3.connect(self.file_name)
+            self.db.execute("PRAGMA query_only = 1")
+            self.db.set_progress_handler(self.should_abort, 1000)
+            version = self.data_version()
+
+            for sql, params in self.queries:
+                while True:
+                    # yield to interactive queries
+                    self._idle.wait()
+                    if self.isInterruptionRequested():
+                        return
+
+                    try:
+                        if self.data_version() != version:
+                            return
+
+                        rows = self.db.execute(sql, params).fetchall()
+
+                        # results read across a change are stale, drop them
+                        if self.data_version() != version:
+                            return
+                    except sqlite3.DatabaseError as e:
+                        if e.args[0] == 'interrupted':
+                            continue    # paused mid-query, retry once resumed
+                        print(e.args[0])
+                        break
+
+                    self.result_ready.emit((sql, tuple(params)), [x[1] for x in rows])
+                    break
+        except sqlite3.DatabaseError as e:
+            print(e.args[0])
+        finally:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def data_version(self):
+        return self.db.execute("PRAGMA data_version").fetchone()[0]
+
+    def should_abort(self):
+        # called by sqlite3 while a statement runs, non-zero aborts it
+        return not self._idle.is_set() or self.isInterruptionRequested()
+
+    def pause(self):
+        self._idle.clear()
+
+    def resume(self):
+        self._idle.set()
+
+    def stop(self):
+        self.requestInterruption()
+        self._idle.set()
+        self.wait()
+
 
 # Main dialog window with menu
 class Dialog(QDialog):
@@ -78,9 +221,16 @@ class Dialog(QDialog):
     MSG_NOT_DB = "<p>Loaded file is not recognised as a SQL database. <br>Schema check " \
                  " routine will be ignored until a proper database is loaded </p>"
     MSG_SQL_EMPTY = "Make sure to provide at least one query"
+    MSG_NO_HISTORY = "Query history is not available"
 
     sql_template = "SELECT * FROM adas_events WHERE "
 
+    # number of saved/frequent queries warmed up on database open
+    prefetch_count = 12
+
+    # number of results kept in the result cache (least recently used go first)
+    cache_size = 32
+
     def __init__(self, screen, parent=None):
         super(Dialog, self).__init__(parent=parent)
 
@@ -90,6 +240,18 @@ class Dialog(QDialog):
         self.log_results = []
         self._limit = '1000'
         self._count = 0
+        self._result_cache = OrderedDict()
+        self._data_version = None
+        self._prefetch_version = None
+        self.db = None
+        self.prefetch = None
+
+        # history is optional, the finder works without it
+        try:
+            self.query_store = QueryStore(history_db)
+        except sqlite3.DatabaseError as e:
+            print(e.args[0])
+            self.query_store = None
 
         # screen related
         if screen:
@@ -136,6 +298,12 @@ class Dialog(QDialog):
                                 triggered=self.open_db)
         self.act_open.setStatusTip('Open ADAS database...')
 
+        self.act_save_query = QAction('&Save Query', self,
+                                      statusTip="Save the current query",
+                                      triggered=self.save_query)
+        self.act_save_query.setStatusTip('Save the current query for prefetching...')
+        self.act_save_query.setDisabled(True)
+
         self.act_about = QAction('&About', self,
                                  statusTip="Informations regarding the ADAS Log finder",
                                  triggered=self.about)
@@ -162,6 +330,7 @@ class Dialog(QDialog):
 
         self.menuBar.addMenu(self.dbMenu)
         self.dbMenu.addAction(self.act_open)
+        self.dbMenu.addAction(self.act_save_query)
 
         self.menuBar.addMenu(self.quMenu)
         self.quMenu.addActions(list(self.list_qu_actions))
@@ -331,7 +500,7 @@ class Dialog(QDialog):
 
         # !can be better
         self._query_val = [x for x in self._query_val if x[1] != sender_schema]
-        self._query_str = ' '.join(list(map(lambda x: ' '.join(x), self._query_val)))
+        self._query_str = self.display_query(self._query_val)
         self.count = len(self._query_val)
 
         if self.count == 0:
@@ -350,6 +519,7 @@ class Dialog(QDialog):
         self.qu_cbes_enable()
         self.bu1.setDisabled(False)
         self.bu2.setDisabled(False)
+        self.act_save_query.setDisabled(self.query_store is None)
 
     def warning_box(self):
         sender = self.sender()
@@ -395,11 +565,18 @@ class Dialog(QDialog):
         # if valid, then triggers sqlite3 connect
         if file_name:
 
+            # results and prefetching belong to the previous database
+            self.stop_prefetch()
+            self._result_cache = OrderedDict()
+
             # load the database
             self.db = sqlite3.connect(file_name)
             self.check_db()
 
             if self.db_status:
+                self._data_version = self.data_version()
+                self.start_prefetch(file_name)
+
                 # enable the query
                 QMessageBox.information(self, "Information", self.MSG_DB_SUCCESS)
 
@@ -436,6 +613,117 @@ class Dialog(QDialog):
 
             pass
 
+    def data_version(self):
+        return self.db.execute("PRAGMA data_version").fetchone()[0]
+
+    def build_sql(self, query_val):
+        # values are bound as parameters, never inlined into the SQL
+        query_str = ' '.join(list(map(lambda x: ' '.join([x[0], x[1], x[2], '?']), query_val)))
+        params = [self.query_param(x[2], x[3]) for x in query_val]
+
+        return self.sql_template + query_str + ' LIMIT ' + self._limit, params
+
+    def query_param(self, opr, val):
+        if opr == 'LIKE':
+            return '%' + val + '%'
+
+        # numeric schemas are compared as numbers
+        for conv in (int, float):
+            try:
+                return conv(val)
+            except ValueError:
+                pass
+
+        return val
+
+    def display_query(self, query_val):
+        # human readable form of the query, only shown in the query box
+        def literal(x):
+            param = self.query_param(x[2], x[3])
+            if isinstance(param, str):
+                return "'" + param.replace("'", "''") + "'"
+            return x[3]
+
+        return ' '.join(list(map(lambda x: ' '.join([x[0], x[1], x[2], literal(x)]), query_val)))
+
+    def start_prefetch(self, file_name):
+        if not self.query_store:
+            return
+
+        try:
+            queries = [self.build_sql(x) for x in self.query_store.most_used(self.prefetch_count)]
+        except sqlite3.DatabaseError as e:
+            self.disable_history(e)
+            return
+
+        if not queries:
+            return
+
+        # results are only valid for the database version they were read at
+        self._prefetch_version = self._data_version
+        self.prefetch = PrefetchWorker(file_name, queries, self)
+        self.prefetch.result_ready.connect(self.cache_result)
+        self.prefetch.start(QThread.IdlePriority)
+
+    def stop_prefetch(self):
+        if self.prefetch:
+            self.prefetch.result_ready.disconnect(self.cache_result)
+            self.prefetch.stop()
+            self.prefetch.deleteLater()
+            self.prefetch = None
+
+    def cache_result(self, key, log_results):
+        # drop results still queued from a worker of a previous database, or
+        # read before the database changed
+        sender = self.sender()
+        if sender is None or sender is not self.prefetch:
+            return
+        if self._data_version != self._prefetch_version:
+            return
+
+        self.store_result(key, log_results)
+
+    def store_result(self, key, log_results):
+        self._result_cache[key] = log_results
+        self._result_cache.move_to_end(key)
+
+        while len(self._result_cache) > self.cache_size:
+            self._result_cache.popitem(last=False)
+
+    def record_query(self, query_val, saved=False):
+        if not self.query_store:
+            return
+
+        try:
+            self.query_store.record(query_val, saved)
+        except sqlite3.DatabaseError as e:
+            self.disable_history(e)
+
+    def disable_history(self, error):
+        print(error.args[0])
+        try:
+            self.query_store.close()
+        except sqlite3.Error:
+            pass
+
+        self.query_store = None
+        self.act_save_query.setDisabled(True)
+
+    def save_query(self):
+        if not self.query_store:
+            QMessageBox.information(self, "Warning", self.MSG_NO_HISTORY)
+        elif self._count > 0:
+            self.record_query(self._query_val, saved=True)
+        else:
+            QMessageBox.information(self, "Warning", self.MSG_SQL_EMPTY)
+
+    def done(self, result):
+        self.stop_prefetch()
+        if self.query_store:
+            self.query_store.close()
+            self.query_store = None
+        super(Dialog, self).done(result)
+
     def clear_query(self):
         self.query_text.setText("SELECT * FROM [table_name] WHERE [queries]")
         self._count = 0
@@ -448,14 +736,36 @@ class Dialog(QDialog):
     def submit_query(self):
 
         if self._count > 0:
-            self.submitted_sql_query = self.sql_template + self._query_str + ' LIMIT ' + self._limit
-            print(self.submitted_sql_query)
+            self.submitted_sql_query, params = self.build_sql(self._query_val)
+            key = (self.submitted_sql_query, tuple(params))
+            print(self.submitted_sql_query, params)
+
+            # interactive queries go first
+            if self.prefetch:
+                self.prefetch.pause()
+
+            try:
+                # cached results are only valid until the database changes
+                version = self.data_version()
+                if version != self._data_version:
+                    self._result_cache = OrderedDict()
+                    self._data_version = version
+
+                if key in self._result_cache:
+                    self.log_results = self._result_cache[key]
+                    self._result_cache.move_to_end(key)
+                else:
+                    c = self.db.cursor()
+                    c.execute(self.submitted_sql_query, params)
 
-            c = self.db.cursor()
-            c.execute(self.submitted_sql_query)
+                    rows = c.fetchall()
+                    self.log_results = [x[1] for x in rows]
+                    self.store_result(key, self.log_results)
+            finally:
+                if self.prefetch:
+                    self.prefetch.resume()
 
-            rows = c.fetchall()
-            self.log_results = [x[1] for x in rows]
+            self.record_query(self._query_val)
             self.res_label.setText("\n".join(self.log_results))
         else:
             QMessageBox.information(self, "Warning", self.MSG_SQL_EMPTY)
@@ -615,10 +925,8 @@ class QueryDialog(QDialog):
         opr = self.query_tuple[0]
         sch = events_schema[self.choice]
 
-        if self.choice in ['lname', 'ldate', 'lvn']:
-            val = "'%" + self.query_tuple[1] + "%'"
-        else:
-            val = self.query_tuple[1]
+        # keep the bare value, build_sql binds it as a parameter
+        val = self.query_tuple[1]
 
         built_query = [qopr, sch, opr, val]
 
@@ -626,7 +934,7 @@ class QueryDialog(QDialog):
         print(self.parent()._query_val)
         self.parent()._query_val = self.parent()._query_val + [built_query]
         print(self.parent()._query_val)
-        self.parent()._query_str = ' '.join(list(map(lambda x: ' '.join(x), self.parent()._query_val)))
+        self.parent()._query_str = self.parent().display_query(self.parent()._query_val)
         self.parent().query_text.setDisabled(False)
         self.parent().query_text.setText(self.parent().sql_template + self.parent()._query_str)
         self.parent()._count += 1